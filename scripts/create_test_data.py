@@ -11,7 +11,7 @@
 
 Using a manually curated list, query the Catalog API with pubmed IDs and a bunch of GCST accessions (gcsts.txt).
 
-- Test data are gzip compressed TSV files
+- Test data are zstd compressed TSV files (or gzip, with --compression gzip)
 - These files contain roughly 5% of the original sumstat files
 - Written to the tests/data directory
 
@@ -20,11 +20,32 @@ Run this script with uv to automatically install the dependencies:
 $ uv run create_test_data.py
 """
 
-import requests
-import duckdb
-import re
+import argparse
+import collections
+import functools
+import json
+import os
 import pathlib
-from tenacity import retry, wait_exponential
+import re
+import shutil
+import subprocess
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+import duckdb
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 PUBMED_IDS = [
     34662886,
@@ -39,9 +60,67 @@ PUBMED_IDS = [
     37949852,
 ]
 
+GCST_RE = re.compile(r"GCST\d+")
+TSV_RE = re.compile(r'href="([^"]+\.(?:tsv\.gz|tsv))"')
+
+# reuse connections (keep-alive) across API pages and FTP directory listings
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=20, pool_maxsize=50))
+SESSION.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50))
+# (connect, read) seconds, so a stalled connection can't block a worker forever
+TIMEOUT = (10, 60)
+
+# API responses are cached between runs, refreshed after a day
+CACHE_DIR = pathlib.Path.home() / ".cache" / "gwascatalog_gene"
+CACHE_MAX_AGE = 24 * 60 * 60
+
+# worker threads for resolving and sampling sumstats files (network I/O bound)
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 5)
+
+# concurrent sample_csv jobs, bounds duckdb read buffers and load on EBI
+MAX_IN_FLIGHT = 10
+
+# queued FTP directory lookups, so sample_csv jobs don't queue behind all of them
+MAX_RESOLVING = 10
+
+# zstd decompresses faster than gzip at a similar ratio
+SUFFIXES = {"zstd": ".tsv.zst", "gzip": ".tsv.gz"}
+
+# compress samples with multithreaded pigz when it's installed
+PIGZ = shutil.which("pigz")
+PIGZ_THREADS = 4
+
+# one in-memory database (and httpfs extension) shared by every sample_csv call
+DB = duckdb.connect(":memory:")
+
+
+def log_retry(retry_state):
+    """Print a failed attempt before tenacity sleeps"""
+    print(
+        f"Retrying {retry_state.fn.__name__} "
+        f"(attempt {retry_state.attempt_number}): {retry_state.outcome.exception()}"
+    )
+
+
+# jittered backoff stops worker threads retrying in lockstep (EBI load balancer)
+retry_ebi = retry(
+    wait=wait_random_exponential(multiplier=0.5, max=10),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type(
+        (requests.ConnectionError, requests.Timeout, requests.HTTPError)
+    ),
+    before_sleep=log_retry,
+    reraise=True,
+)
+
 
 def get_gcst_from_pubmed(pubmed_id):
     """Get a list of gene-based GCSTs from a pubmed id"""
+    cache_path = CACHE_DIR / f"pubmed_{pubmed_id}.json"
+    if cache_path.exists() and time.time() - cache_path.stat().st_mtime < CACHE_MAX_AGE:
+        print(f"Using cached studies for {pubmed_id=}")
+        return json.loads(cache_path.read_text())
+
     BASE_URL = (
         "https://www.ebi.ac.uk/gwas/rest/api/studies/search/findByPublicationIdPubmedId"
     )
@@ -55,10 +134,11 @@ def get_gcst_from_pubmed(pubmed_id):
         print(f"Fetching {pubmed_id=} {page=}...")
 
         # Send the request
-        response = requests.get(
+        response = SESSION.get(
             BASE_URL,
             params={"pubmedId": pubmed_id, "page": page, "size": size},
             headers=HEADERS,
+            timeout=TIMEOUT,
         )
         response.raise_for_status()
         data = response.json()
@@ -78,29 +158,46 @@ def get_gcst_from_pubmed(pubmed_id):
 
         page += 1
 
+    # don't cache a missing result, and replace atomically so an interrupted
+    # write can't leave truncated JSON behind
+    if study_links:
+        CACHE_DIR.mkdir(exist_ok=True, parents=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+        tmp_path.write_text(json.dumps(study_links))
+        os.replace(tmp_path, cache_path)
+
     return study_links
 
 
 def get_directory_range(n):
     """Create an FTP directory range
 
-    90083565 -> 90083001, 90084000
-    90083000 -> 90082001, 90083000
+    >>> get_directory_range(90083565)
+    (90083001, 90084000)
+    >>> get_directory_range(90083000)
+    (90082001, 90083000)
+    >>> get_directory_range(1)
+    (1, 1000)
+    >>> get_directory_range(999)
+    (1, 1000)
+    >>> get_directory_range(1000)
+    (1, 1000)
+    >>> get_directory_range(1001)
+    (1001, 2000)
     """
-    if n % 1000 == 0:
-        n -= 1
-    lower = (n // 1000) * 1000 + 1
-    upper = (n // 1000 + 1) * 1000
+    lower = (n - 1) // 1000 * 1000 + 1
+    upper = lower + 999
     return lower, upper
 
 
-@retry(wait=wait_exponential(multiplier=1, min=2, max=10))  # (EBI load balancer)
+@functools.cache
+@retry_ebi
 def make_ftp_url(gcst_url):
     """Make an FTP url that links to a sumstats directory from a GCST accession"""
     base_url = "http://ftp.ebi.ac.uk/pub/databases/gwas/summary_statistics"
 
     # Extract GCST ID (e.g., "GCST90082112")
-    match = re.search(r"GCST\d+", gcst_url)
+    match = GCST_RE.search(gcst_url)
     if not match:
         raise ValueError(f"GCST URL does not contain GCST {gcst_url}")
 
@@ -118,82 +215,187 @@ def make_ftp_url(gcst_url):
     return full_url
 
 
-@retry(wait=wait_exponential(multiplier=1, min=2, max=10))  # (EBI load balancer)
+@functools.cache
+@retry_ebi
 def get_tsv_url(url):
     """Get a TSV URL (possibly gzip compressed) from an FTP directory listing"""
-    response = requests.get(url)
+    # read the whole (small) listing, so the connection goes back to the pool
+    response = SESSION.get(url, timeout=TIMEOUT)
     response.raise_for_status()
 
     # Use regex to find the first TSV link (there should only be one)
-    try:
-        tsv_file = re.findall(r'href="([^"]+\.(?:tsv\.gz|tsv))"', response.text)[0]
-    except IndexError:
+    match = TSV_RE.search(response.text)
+    if not match:
         raise ValueError(f"Couldn't find TSV file at {url}")
 
-    return url + "/" + tsv_file
+    return url + "/" + match.group(1)
 
 
-def sample_csv(path, outf, overwrite=False):
-    """Reproducibly sample 5% of rows from a text file and write to a TSV"""
+def sample_csv(path, outf, overwrite=False, compression="zstd"):
+    """Reproducibly sample 5% of rows from a text file and write to a compressed TSV"""
     if pathlib.Path(outf).exists() and not overwrite:
         print(f"File {outf} already exists, skipping")
     else:
         print(f"Writing {outf}")
-        with duckdb.connect(":memory:") as conn:
-            # duckdb fetches the remote TSV and decompresses it magically
+        # write to a temporary file, so an interrupted run can't leave behind a
+        # truncated sample that later runs would skip
+        tmp_outf = f"{outf}.tmp"
+        # cursors are cheap, thread safe children of the shared database
+        with DB.cursor() as conn:
+            # duckdb fetches the remote TSV, compression is known from the URL
             # seed = 42 for reproducibility
+            read_compression = "gzip" if path.endswith(".gz") else "none"
+            # duckdb's gzip writer is single threaded, pigz isn't
+            use_pigz = compression == "gzip" and PIGZ
+            write_compression = "none" if use_pigz else compression
             sql = f"""
-            COPY (SELECT * FROM read_csv(\"{path}\") 
-            USING SAMPLE 5% (system, 42))        
-            TO \"{outf}\"
-            DELIMITER '\t';        
+            COPY (SELECT * FROM read_csv(\"{path}\", compression = '{read_compression}')
+            USING SAMPLE 5% (system, 42))
+            TO \"{tmp_outf}\"
+            (DELIMITER '\t', COMPRESSION '{write_compression}');
             """
-            conn.execute(sql)
+            # COPY reports the rows written, so the sample doesn't need re-reading
+            (n_rows,) = conn.execute(sql).fetchone()
 
+        if n_rows == 0:
+            # system sampling picks whole chunks, so small files can sample nothing.
+            # the seed makes that deterministic: keep the header only file so later
+            # runs skip it instead of downloading it again
+            print(f"Warning: sampled no rows from {path}, {outf} is header only")
 
-def get_sumstats_from_pubmed_id(pubmed_id):
-    """Query the Catalog API with a pubmed ID and download sampled sumstats files"""
-    links = get_gcst_from_pubmed(pubmed_id)
-    test_data_path = pathlib.Path(__file__).parent.parent.resolve() / "tests" / "data"
-    (test_data_path / str(pubmed_id)).mkdir(exist_ok=True, parents=True)
+        if use_pigz:
+            # compresses in place to tmp_outf.gz, -n leaves the temporary file name
+            # and mtime out of the header so regenerated files are identical
+            subprocess.run(
+                [PIGZ, "-n", "-p", str(PIGZ_THREADS), "-f", tmp_outf], check=True
+            )
+            tmp_outf += ".gz"
+
+        os.replace(tmp_outf, outf)
+
+
+def read_gcsts():
+    # skip the header comment, splitlines() drops the newlines
+    return pathlib.Path("gcsts.txt").read_text().splitlines()[1:]
+
+
+def list_files(path):
+    """Get the names of files in a directory with a single scandir"""
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
 
+
+def resolve_tsv_url(gcst_url):
+    """Get the sumstats TSV URL for a GCST accession or API link"""
+    return get_tsv_url(make_ftp_url(gcst_url))
+
+
+def missing_sumstats(links, out_path, suffix):
+    """Yield (GCST link, output path) pairs for sumstats that weren't sampled yet"""
+    existing = list_files(out_path)
     for link in links:
-        url = make_ftp_url(link)
-        tsv_url = get_tsv_url(url)
-        outf = str(test_data_path / str(pubmed_id) / f"{link.split("/")[-1]}.tsv.gz")
-        sample_csv(path=tsv_url, outf=outf)
+        outf = out_path / f"{link.split('/')[-1]}{suffix}"
+        if outf.name in existing:
+            print(f"File {outf} already exists, skipping")
+        else:
+            yield link, outf
 
-    return len(links)
 
+def query_gwascatalog_api(ex, compression):
+    """Yield (output path, TSV URL) pairs for gene-based sumstats as they resolve
 
-def read_gcsts():
-    with open("gcsts.txt") as f:
-        next(f)  # skip the header comment
-        return f.readlines()
+    Pubmed IDs and curated GCST accessions (gcsts.txt) are queried on the
+    executor. Only MAX_RESOLVING URL lookups are queued at a time, topped up as
+    they finish (links from pubmed IDs first), so sample_csv jobs submitted by the
+    consumer don't wait behind every lookup. Sumstats that were already sampled
+    are skipped without resolving their URL.
+    """
+    test_data_path = pathlib.Path(__file__).parent.parent.resolve() / "tests" / "data"
+    suffix = SUFFIXES[compression]
+    studies = {ex.submit(get_gcst_from_pubmed, p): p for p in PUBMED_IDS}
+    curated = missing_sumstats(read_gcsts(), test_data_path / "gcsts", suffix)
+    pubmed_links = collections.deque()
+    sumstats = {}
+    pending = set(studies)
 
+    while True:
+        while len(sumstats) < MAX_RESOLVING:
+            job = pubmed_links.popleft() if pubmed_links else next(curated, None)
+            if job is None:
+                break
+            link, outf = job
+            future = ex.submit(resolve_tsv_url, link)
+            sumstats[future] = outf
+            pending.add(future)
+
+        if not pending:
+            return
+
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in studies:
+                pubmed_id = studies.pop(future)
+                links = future.result()
+                if not links:
+                    # no GCSTs were found from a pubmed ID. that's bad!
+                    raise ValueError(f"No sumstats found for {pubmed_id=}")
+                pubmed_path = test_data_path / str(pubmed_id)
+                pubmed_links.extend(missing_sumstats(links, pubmed_path, suffix))
+            else:
+                yield sumstats.pop(future), future.result()
+
+
+def download_sumstats(ex, sumstats, compression):
+    """Sample each (output path, TSV URL) pair on the executor as it arrives
+
+    At most MAX_IN_FLIGHT samples are submitted at once
+    """
+    pending = set()
+    for outf, tsv_url in sumstats:
+        if len(pending) >= MAX_IN_FLIGHT:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+        # query_gwascatalog_api already skipped existing files, don't stat again
+        outf.parent.mkdir(exist_ok=True, parents=True)
+        pending.add(
+            ex.submit(
+                sample_csv,
+                path=tsv_url,
+                outf=str(outf),
+                overwrite=True,
+                compression=compression,
+            )
+        )
 
-def get_sumstat_from_gcst(gcst):
-    """Query the Catalog API with a GCST accession and download sampled sumstats files"""
-    test_data_path = (
-        pathlib.Path(__file__).parent.parent.resolve() / "tests" / "data" / "gcsts"
-    )
-    test_data_path.mkdir(exist_ok=True, parents=True)
-    url = make_ftp_url(gcst)
-    tsv_url = get_tsv_url(url)
-    outf = str(test_data_path / f"{gcst.split('/')[-1].strip()}.tsv.gz")
-    sample_csv(path=tsv_url, outf=outf)
+    for future in as_completed(pending):
+        future.result()
 
 
 def main() -> None:
-    for pubmed_id in PUBMED_IDS:
-        n_processed = get_sumstats_from_pubmed_id(pubmed_id)
-        if n_processed == 0:
-            # no GCSTs were found from a pubmed ID. that's bad!
-            raise ValueError(f"No sumstats downloaded for {pubmed_id=}")
-
-    gcsts = read_gcsts()
-    for gcst in gcsts:
-        get_sumstat_from_gcst(gcst)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--compression",
+        choices=SUFFIXES,
+        default="zstd",
+        help="compression for the sampled TSVs (gzip if zstd isn't available)",
+    )
+    args = parser.parse_args()
+
+    # one pool for API queries, directory listings and sampling, so there's no
+    # barrier between resolving URLs and downloading sumstats
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        try:
+            sumstats = query_gwascatalog_api(ex, args.compression)
+            download_sumstats(ex, sumstats, args.compression)
+        except BaseException:
+            # fail fast, don't work through the queued lookups first
+            ex.shutdown(cancel_futures=True)
+            raise
 
 
 if __name__ == "__main__":